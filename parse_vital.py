@@ -5,17 +5,78 @@
 
 
 
-import gzip
+# ISA-L decompresses gzip much faster than zlib. Use it if it is installed
+try:
+    from isal import igzip as gzip
+    has_isal = True
+except ImportError:
+    import gzip
+    has_isal = False
+# Without ISA-L, zlib is used directly to skip the gzip module's extra layer
+import zlib
+import bz2
+import lzma
+# rapidgzip decompresses in parallel, which pays off for large recordings
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+# joblib is used to save tracks in parallel
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    Parallel = None
 from construct import *
 import warnings
-import io
+import os
 from pathlib import Path
 import collections
 import textwrap
+import numpy as np
 import pandas as pd
 
 # Import file construct obj
-from vital_file_struct import body_str, header_str
+from vital_file_struct import adc_apply, header_str, packet_types, parse_packet, parse_rec, parse_recs, rec_headers, scan_packets, PKT_HDR, REC_HDR
+
+def decompress_file(path):
+    '''
+    Return the decompressed content of a gzip file
+    '''
+    if rapidgzip is not None:
+        # Open the file here, so a missing file raises FileNotFoundError
+        with open(path, 'rb') as raw, \
+                rapidgzip.open(raw.fileno(), parallelization=os.cpu_count()) as f:
+            return f.read()
+
+    data = Path(path).read_bytes()
+    if has_isal:
+        return gzip.decompress(data)
+
+    # A gzip file may consist of several members, each is decompressed in turn.
+    # Zero padding after the last member is ignored, like gzip.decompress does.
+    parts = []
+    while data:
+        d = zlib.decompressobj(wbits = 31)
+        parts.append(d.decompress(data))
+        if not d.eof:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+        data = d.unused_data.lstrip(b'\0')
+    return b''.join(parts)
+
+# Openers for compressed csv files, by suffix. Other suffixes are written uncompressed
+csv_openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+# Suffixes pandas would compress, but which write_csv does not support
+unsupported_csv_suffixes = {'.zip', '.zst', '.tar'}
+
+def csv_rows(stamps, values, unit):
+    '''
+    Format datetime64[ns] stamps and float values as csv rows of time,value
+    '''
+    times = np.datetime_as_string(stamps, unit = unit)
+    times = np.char.add(np.char.replace(times, 'T', ' '), '+00:00,')
+    # Missing values are empty, like in to_csv
+    vals = np.where(np.isnan(values), '', values.astype(str))
+    return '\n'.join(np.char.add(times, vals).tolist()) + '\n'
 
 class Track:
     '''
@@ -23,24 +84,89 @@ class Track:
     '''
     def __init__(self, vital_obj, trkid):
         # Get rec from trkid
-        self.info, = (trk for trk in vital_obj.track_info if trk.trkid == trkid)
-        self.recs = [rec for rec in vital_obj.recs if rec.trkid == trkid]
-        self.devname = 'VITAL' if self.info.devid == 0 else \
-            [dev.devname for dev in vital_obj.dev_info if dev.devid == self.info.devid][-1]
-        
-        # Convert values using adc_gain and adc_offset
-        for i, rec in enumerate(self.recs):
-            if self.info.rec_type == 1: # Waveform
-                self.recs[i]['values'].vals_real = [val * self.info.adc_gain + self.info.adc_offset for val in rec['values'].vals]
-            elif self.info.rec_type == 2: # Numeric
-                self.recs[i]['values'].vals_real = rec['values'].val[0] * self.info.adc_gain + self.info.adc_offset 
-            elif self.info.rec_type == 5: # String (Annotation)
-                self.recs[i]['values'].vals_real = rec['values'].sval
-                self.recs[i]['values'].num = 1 # There is only one value (string) per rec
-            else: 
-                raise Exception(f'Unknown rec_type: {self.info.rec_type}')
+        self.info = vital_obj.track_info_by_trkid[trkid]
+        self._rec_ids = vital_obj.recs_by_trkid.get(trkid, np.array([], dtype=np.int64))
+        # Recs are parsed the first time they are needed, see recs.
+        # Their values are converted when they are needed, see vals_real
+        self._vital = vital_obj
+        self._recs = None
+        # Start time of each rec as unix timestamp
+        self.rec_dts = vital_obj.rec_dts[self._rec_ids]
+        self.source_path = vital_obj.source_path
+        self.devname = 'VITAL' if self.info.devid == 0 else vital_obj.dev_info_by_devid[self.info.devid].devname
+
+        # An unknown rec_type is only an error if the track has recs to convert
+        if len(self._rec_ids) > 0 and self.info.rec_type not in (1, 2, 5):
+            raise Exception(f'Unknown rec_type: {self.info.rec_type}')
+
+    @property
+    def recs(self):
+        '''
+        Parsed recs of the track, in file order
+        '''
+        if self._recs is None:
+            self._recs = self._vital.get_recs(self._rec_ids)
+        return self._recs
+
+    def __getstate__(self):
+        # Send parsed recs instead of the whole Vital object (e.g. to joblib workers)
+        state = self.__dict__.copy()
+        state['_recs'] = self.recs
+        state['_vital'] = None
+        return state
+
+    def vals_real(self, rec, dtype = np.float64):
+        '''
+        Values of rec converted using adc_gain and adc_offset
+        '''
+        if self.info.rec_type == 1: # Waveform
+            # vals is an ndarray view into the file buffer
+            return rec['values'].vals.astype(dtype) * self.info.adc_gain + self.info.adc_offset
+        elif self.info.rec_type == 2: # Numeric
+            return np.dtype(dtype).type(rec['values'].val[0] * self.info.adc_gain + self.info.adc_offset)
+        else: # String (Annotation)
+            return rec['values'].sval
+
+    def all_vals_real(self, n_values, dtype = np.float64, recs = None):
+        '''
+        Converted values of all recs (or of recs, if given) in one array of length n_values.
+        Numeric values are returned as dtype
+        '''
+        if recs is None:
+            recs = self.recs
+        rec_type = self.info.rec_type
+        gain = self.info.adc_gain
+        offset = self.info.adc_offset
+
+        if rec_type == 5: # String (Annotation)
+            return np.array([rec['values'].sval for rec in recs], dtype=object)
+
+        if rec_type == 2: # Numeric
+            vals_real = np.array([rec['values'].val[0] for rec in recs], dtype=np.float64)
+            vals_real *= gain
+            vals_real += offset
+            return vals_real.astype(dtype, copy=False)
+
+        vals_real = np.empty(n_values, dtype=dtype)
+
+        # Waveform. With numba, all samples of the track are converted in one parallel loop
+        if adc_apply is not None and np.dtype(dtype) == np.float64 and n_values > 0:
+            raw = np.concatenate([rec['values'].vals for rec in recs])
+            adc_apply(raw, gain, offset, vals_real)
+            return vals_real
+
+        # Otherwise convert each rec directly into its part of the output,
+        # without temporary arrays.
+        pos = 0
+        for rec in recs:
+            values = rec['values']
+            part = vals_real[pos:pos + values.num]
+            np.multiply(values.vals, gain, out=part, dtype=dtype)
+            np.add(part, offset, out=part)
+            pos += values.num
+
+        return vals_real
 
-        
     def __str__(self):
         n_recs = [rec['values'].num for rec in self.recs]
         
@@ -53,35 +179,85 @@ class Track:
             --------------------------
             ''')
 
-    def to_pandas_ts(self, concat_list = True):
+    def to_pandas_ts(self, concat_list = True, dtype = np.float64):
         '''
-        Convert track to data frame with time and (real) value
+        Convert track to data frame with time and (real) value.
+        Numeric values are of type dtype. np.float32 halves the memory used by long waveforms.
         '''
 
-        try:
-            # In events srate us 0. As there is only one value per rec, it can just be set to None
-            freq = f'{1000/self.info.srate}ms'
-        except ZeroDivisionError:
-            freq = None
-
+        lens = np.array([rec['values'].num for rec in self.recs], dtype=np.int64)
+        index = self.sample_times(lens)
 
-        pandas_ts = []
+        if not concat_list:
+            # Split the index instead of calling pd.date_range for each rec
+            bounds = np.cumsum(lens)[:-1]
+            return [pd.Series(self.vals_real(rec, dtype), index = rec_index)
+                    for rec, rec_index in zip(self.recs, np.split(index, bounds))]
 
-        for rec in self.recs:
-            index = pd.date_range(start = rec.dt.datetime, freq = freq, periods = rec['values'].num)
-            pandas_ts.append(pd.Series(rec['values'].vals_real, index = index))
-        
-        if concat_list:
-            pandas_ts = pd.concat(pandas_ts)
+        # The values are a new array, so pandas does not need its own copy
+        return pd.Series(self.all_vals_real(lens.sum(), dtype), index = index, copy = False)
 
-        return pandas_ts
+    def sample_times(self, lens):
+        '''
+        UTC DatetimeIndex of all samples, given the number of values in each rec.
+        Each sample is the start of its rec plus n sample periods.
+        '''
+        stamps = self._sample_stamps(self.rec_dts, lens)
+        return pd.DatetimeIndex(stamps.view('datetime64[ns]')).tz_localize('UTC')
+
+    def _period_ns(self):
+        # In events srate is 0. There is only one value per rec, so the period does not matter
+        return 0 if self.info.srate == 0 else round(1e9 / self.info.srate)
+
+    def _sample_stamps(self, rec_dts, lens):
+        # Sample times in ns (int64) of recs starting at rec_dts, with lens values each.
+        # Start times are rounded to microseconds, like rec.dt. The fraction is
+        # rounded on its own, as dt * 1e6 is not exact for current timestamps.
+        seconds = np.floor(rec_dts)
+        starts = (seconds.astype(np.int64) * 1_000_000 + np.round((rec_dts - seconds) * 1e6).astype(np.int64)) * 1000
+        first_sample = np.repeat(np.cumsum(lens) - lens, lens)
+        sample_no = np.arange(lens.sum(), dtype=np.int64) - first_sample
+        return np.repeat(starts, lens) + sample_no * self._period_ns()
+
+    def write_csv(self, file_path, compress = False, chunk_size = 1 << 20):
+        '''
+        Write numeric track as csv rows of time,value.
+        The file is gzipped if compress is set, otherwise compression is inferred from
+        the suffix (.gz, .bz2 or .xz).
+        Recs are converted and written in groups of about chunk_size values,
+        so the whole track is never held in memory. Rows are formatted by numpy
+        (csv_rows), which is much faster than Series.to_csv.
+        '''
+        suffix = '.gz' if compress else Path(file_path).suffix
+        if suffix in unsupported_csv_suffixes:
+            raise ValueError(f'Cannot write {suffix} compressed csv, use .gz, .bz2 or .xz')
+        opener = csv_openers.get(suffix, open)
+
+        lens = np.array([rec['values'].num for rec in self.recs], dtype=np.int64)
+        ends = np.cumsum(lens)
+
+        # Only show nanoseconds if sample times need them. Rec starts are whole
+        # microseconds, so only the offsets within the longest rec matter.
+        max_len = int(lens.max()) if len(lens) else 0
+        unit = 'us' if (np.arange(max_len, dtype=np.int64) * self._period_ns() % 1000 == 0).all() else 'ns'
+
+        # Index of the first rec of each group
+        group_starts = np.unique(np.searchsorted(ends, np.arange(0, ends[-1] if len(ends) else 0, chunk_size), side='right'))
+        bounds = np.append(group_starts, len(lens)).tolist()
+
+        with opener(file_path, 'wt', newline = '') as f:
+            for first, last in zip(bounds[:-1], bounds[1:]):
+                group_lens = lens[first:last]
+                stamps = self._sample_stamps(self.rec_dts[first:last], group_lens)
+                values = self.all_vals_real(int(group_lens.sum()), np.float64, self.recs[first:last])
+                f.write(csv_rows(stamps.view('datetime64[ns]'), values, unit))
 
     def save_to_file(self, folder_path = None, file_name = None, gzip = False):
         '''
         Save csv file containing track
         '''
         if file_name is None:
-            file_name = Path(self.info._io.name).stem + '_' + self.info.name + '_' + str(self.info.trkid) + ('.csv.gz' if gzip else '.csv')
+            file_name = self.source_path.stem + '_' + self.info.name + '_' + str(self.info.trkid) + ('.csv.gz' if gzip else '.csv')
         
         if folder_path is None:
             folder_path = 'converted'
@@ -93,42 +269,86 @@ class Track:
 
         file_path = folder_path / file_name
 
-        pandas_ts = self.to_pandas_ts()
-        pandas_ts.to_csv(file_path, header = False, compression='gzip' if gzip else 'infer')
+        if self.info.rec_type == 5:
+            # Strings (annotations) may need quoting, leave that to pandas
+            self.to_pandas_ts().to_csv(file_path, header = False, compression='gzip' if gzip else 'infer')
+        else:
+            self.write_csv(file_path, compress = gzip)
         
         print(f'Saved {file_path}')
         
 
 
+def save_track(track, folder_path, gzip):
+    '''
+    Save a single track. Defined at module level, so joblib can pickle it
+    '''
+    track.save_to_file(folder_path = folder_path, gzip = gzip)
+
+
 class Vital:
     '''
     Class that holds an entire .vital file as a dict
     '''
     def __init__(self, path):
         self.load_vital(path)
-        self.track_info = ListContainer([packet.data for packet in self.file.body if packet.type == 0])
-        self.dev_info = ListContainer([packet.data for packet in self.file.body if packet.type == 9])
 
-        # Event tracks may be duplicated in trackinfo.
-        # Keep only the first EVENTS track.
-        track_names = [trk.name for trk in self.track_info]
-        i_event = [i for i, x in enumerate(track_names) if x == "EVENT"]
-
-        if(len(i_event) > 1):
-            i_event.pop() # Keep one instance
-
-            for i in sorted(i_event, reverse=True):
-                del self.track_info[i]
+        # Sort packets by type in a single pass over the body
+        self.track_info = []
+        self.dev_info = []
+        packets_by_type = {0: self.track_info, 9: self.dev_info}
+        for packet in self.file.body:
+            bucket = packets_by_type.get(packet.type)
+            if bucket is not None:
+                bucket.append(packet.data)
 
-        self.recs = ListContainer([packet.data for packet in self.file.body if packet.type == 1])
+        # Event tracks may be duplicated in trackinfo.
+        # Keep only one EVENT track (the last one, in its place).
+        event_tracks = [trk for trk in self.track_info if trk.name == "EVENT"]
+
+        if len(event_tracks) > 1:
+            kept_event = event_tracks[-1]
+            self.track_info = [trk for trk in self.track_info if trk.name != "EVENT" or trk is kept_event]
+
+        # Lookup tables, so tracks can be fetched without scanning all packets
+        self.track_info_by_trkid = {trk.trkid: trk for trk in self.track_info}
+        self.track_info_by_name = {trk.name: trk for trk in self.track_info}
+        # Names used by more than one track (e.g. from several devices) cannot be looked up by name
+        name_counts = collections.Counter(trk.name for trk in self.track_info)
+        self.ambiguous_track_names = {name for name, count in name_counts.items() if count > 1}
+        # If a device is listed more than once, the last DEVINFO is used
+        self.dev_info_by_devid = {dev.devid: dev for dev in self.dev_info}
+
+        # Indices of the recs of each track, in file order
+        order = np.argsort(self.rec_trkids, kind='stable')
+        trkids, first = np.unique(self.rec_trkids[order], return_index=True)
+        self.recs_by_trkid = dict(zip(trkids.tolist(), np.split(order, first[1:])))
+
+    def get_rec(self, i):
+        '''
+        Parse the i'th REC packet
+        '''
+        start = int(self.rec_offsets[i])
+        return parse_rec(self._raw, start, start + int(self.rec_lens[i]), self.trk_format)
     
+    def get_recs(self, rec_ids):
+        '''
+        Parse the REC packets at indices rec_ids, which must all belong to the same track
+        '''
+        if len(rec_ids) == 0:
+            return []
+        starts = self.rec_offsets[rec_ids]
+        ends = starts + self.rec_lens[rec_ids]
+        trk = self.trk_format[int(self.rec_trkids[rec_ids[0]])]
+        return parse_recs(self._raw, starts.tolist(), ends.tolist(), trk)
+
     def __str__(self):
         '''
         Human readable description when Vital object is printed
         '''
         return textwrap.dedent(f'''
             ======= VITAL FILE INFO =======
-            Path:           {self.file.header._io.filename}
+            Path:           {self.source_path}
             Size:           {self.summed_datalen/1000.0} KB
             Format Ver.:    {self.file.header.format_ver}
             Tracks (n):     {len(self.track_info)}
@@ -151,7 +371,12 @@ class Vital:
         
         # Get trkid if name is given
         if not name is None:
-            trkid_from_name, = (x.trkid for x in self.track_info if x.name == name)
+            if name in self.ambiguous_track_names:
+                trkids = [trk.trkid for trk in self.track_info if trk.name == name]
+                raise ValueError(f'Track name {name} is used by several tracks (trkids {trkids}), use trkid instead')
+            if name not in self.track_info_by_name:
+                raise ValueError(f'No track named {name}')
+            trkid_from_name = self.track_info_by_name[name].trkid
 
             if not trkid is None:
                 assert trkid == trkid_from_name
@@ -178,9 +403,10 @@ class Vital:
 
         print('Saved Track Info (tracks.csv)')
 
-    def save_tracks_to_file(self, trackids = None, names = None, path = None, save_all = False, gzip = False):
+    def save_tracks_to_file(self, trackids = None, names = None, path = None, save_all = False, gzip = False, n_jobs = -1):
         '''
-        Save tracks to individual csv files
+        Save tracks to individual csv files.
+        If joblib is installed, tracks are saved in n_jobs processes (-1 for all cores)
         '''
         
         if path is None:
@@ -198,41 +424,61 @@ class Vital:
             else: 
                 tracks = [self.get_track(trackid = trackid) for trackid in trackids]
 
-        for track in tracks:
-            track.save_to_file(folder_path=path, gzip = gzip)
+        if Parallel is None or n_jobs == 1 or len(tracks) < 2:
+            for track in tracks:
+                track.save_to_file(folder_path=path, gzip = gzip)
+        else:
+            Parallel(n_jobs = n_jobs)(delayed(save_track)(track, path, gzip) for track in tracks)
 
     def load_vital(self, path):
-        
-
-        with gzip.GzipFile(path, 'rb') as f:
-            # the last 4 bits of a gzip files is its unpacked size
-            total_file_size = f.seek(0, io.SEEK_END)
-            f.seek(0)
-            header = header_str.parse_stream(f)
-
-            # Loop until stream error
-            body = ListContainer()
-            completed = False
-            data_read = header.headerlen + 10
-            print('')
-            while not completed:
-                try:
-                    body.append(body_str.parse_stream(f))
-                    data_read = data_read + body[-1].datalen + 5 
-                    print(f'Data read: {round(data_read/1000)} of {total_file_size/1000} kB', end="\r", flush=True)
-                except StreamError:
-                    #print("End of stream reached")
-                    completed = True
-                    print()
-
-        # Check that all packets have been parsed
-        self.summed_datalen = sum([x.datalen + 5 for x in body]) + header.headerlen + 10
-
-        #print("Total file size: " + str(total_file_size/1000) + "kB")
-        assert total_file_size == self.summed_datalen, "The summed datalen does not match the filesize"
-
-        self.vital_filename = Path(path).stem
+        '''
+        Read the file at path.
+        Raises StreamError if the packets do not end exactly at the end of the file
+        '''
 
+        # Decompress the whole file at once and parse it from memory
+        buf = decompress_file(path)
+
+        total_file_size = len(buf)
+        header = header_str.parse(buf)
+        off = header.headerlen + 10
+        trk_format = {}
+
+        # Find all packets first. This loop is compiled if numba is installed.
+        types, offsets, datalens, end = scan_packets(buf, off)
+        if end != total_file_size:
+            raise StreamError('stream ended before end of packet')
+        # One progress line per file. Printing per packet cost more than parsing it.
+        print(f'Data read: {total_file_size/1000} kB in {len(types)} packets')
+
+        # REC packets are not kept as objects. Only their trkid, time and
+        # position in buf are stored, and they are parsed when a track is requested.
+        is_rec = types == 1
+        # Every REC must hold at least its header (infolen, dt, trkid)
+        too_short = is_rec & (datalens < REC_HDR.size)
+        if too_short.any():
+            bad_offset = int(offsets[np.argmax(too_short)]) - PKT_HDR.size
+            raise StreamError(f'REC packet at offset {bad_offset} is shorter than its header')
+        self.rec_offsets = offsets[is_rec]
+        self.rec_lens = datalens[is_rec].astype(np.int32)
+        self.rec_trkids, self.rec_dts = rec_headers(buf, self.rec_offsets)
+
+        body = []
+        for i in np.flatnonzero(~is_rec):
+            pkt_type, datalen, data, _ = parse_packet(buf, int(offsets[i]) - PKT_HDR.size, trk_format)
+            body.append(Container(type=pkt_type, type_str=packet_types.get(pkt_type, 'Unknown'),
+                                  datalen=datalen, data=data))
+        self.trk_format = trk_format
+
+        # The packet scan ended exactly at the end of the file (checked above),
+        # so the summed packet lengths equal the file size
+        self.summed_datalen = end
+
+        self.source_path = Path(path)
+        self.vital_filename = self.source_path.stem
+
+        # Decompressed file. Waveform values are views into this buffer
+        self._raw = buf
         self.file = Container(header=header, body=body)
 
 # When run as __main__ (from command line)
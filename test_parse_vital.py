@@ -1,6 +1,35 @@
 from parse_vital import Vital
 import matplotlib
 
+# Regression check of the parser against known values of the test files:
+# number of tracks, summed_datalen, and the first sample and length of one track per rec_type
+expected = {
+    "test/test_data_demo.vital": (18, 80372, {
+        "ABP": ('2019-07-11 09:54:25.138000+00:00', 79.8125, 4480),            # Waveform
+        "NIBP_SYS": ('2019-07-11 09:54:27.602000+00:00', 120.0, 35),           # Numeric
+        "EVENT": ('2019-07-11 09:54:45.449000+00:00', 'Start ventilator settings', 4)}), # String
+    "test/test_intelliue_demo2.vital": (18, 486412, {
+        "ECG_II": ('2019-07-11 09:47:43.407000+00:00', -0.010000000000005116, 109056),
+        "NIBP_SYS": ('2019-07-11 09:47:45.103000+00:00', 120.0, 213),
+        "EVENT": ('2019-07-11 09:48:35.999000+00:00', 'Start ventolator settings', 7)}),
+    "test/test_intellivue_demo1.vital": (16, 53190, {
+        "ABP": ('2019-06-27 11:14:15.228000+00:00', 95.5, 3200),
+        "NIBP_SYS": ('2019-06-27 11:14:16.892000+00:00', 120.0, 25)}),
+}
+
+for path, (n_tracks, summed_datalen, tracks) in expected.items():
+    vital = Vital(path)
+    assert len(vital.track_info) == n_tracks, path
+    assert vital.summed_datalen == summed_datalen, path
+
+    for name, (first_time, first_value, n_values) in tracks.items():
+        ts = vital.get_track(name=name).to_pandas_ts()
+        assert str(ts.index[0]) == first_time, (path, name)
+        assert ts.iloc[0] == first_value, (path, name)
+        assert len(ts) == n_values, (path, name)
+
+print('Parsed values match')
+
 test_path = "test/test_intellivue_demo1.vital"
 
 test_file = Vital(test_path)
@@ -1,111 +1,22 @@
 from construct import *
-import collections
+import struct
+import arrow
+import numpy as np
+# numba is optional. When installed, the packet chain is walked and
+# waveforms are converted in compiled code
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
 
 # Data types
 DWORD = Int32ul
 WORD = Int16ul
 short = Int16sl
-long_ = Int32sl
-float_ = Float32l
-double_ = Float64l
-String = PascalString(DWORD, "UTF-8")  # String preceded by length Int.
-
-# Track format dict, used to lookup format by trkid
-trk_format = {}
-
-def save_format_hook(obj, ctx):
-    trk_format.update(
-        {obj["trkid"]: obj}
-    )
-
-# Packet structures
-devinfo_str = Struct(
-    "devid" / DWORD,
-    "typename" / String,
-    "devname" / String,
-    "port" / String
-)
-
-# Trkinfo structure
-trkinfo_str = Struct(
-    "trkid" / WORD,
-    "rec_type" / Byte,
-    # Code only tested for float(1) and WORD(6). Others should work as well.
-    "recfmt" / OneOf(Byte, [1, 6]),
-    "name" / String,
-    "unit" / String,
-    "minval" / float_,
-    "maxval" / float_,
-    "color" / Array(4, Byte),  # Color
-    "srate" / float_,
-    "adc_gain" / double_,
-    "adc_offset" / double_,
-    "montype" / Byte,
-    "devid" / DWORD
-)
-
-# CMD sructure
-cmd_str = Struct(
-    "cmd" / Byte,
-    "cmd_str" / Computed(lambda this: collections.defaultdict(lambda: 'Unknown CMD', {5: 'ORDER', 6: 'RESET_EVENTS'})[this.cmd]),
-    "cnt" / If(this.cmd == 5, WORD),
-    "trkids" / If(this.cmd == 5, WORD[this.cnt]),
-)
-
-recfmt_str = Switch(this.recfmt,
-                    {
-                        # Recfmt
-                        1: float_[this.num],
-                        2: double_[this.num],
-                        # Actually char, but does not seemn to be used
-                        3: Byte[this.num],
-                        4: Byte[this.num],
-                        5: short[this.num],
-                        6: WORD[this.num],
-                        7: long_[this.num],
-                        8: DWORD[this.num]
-                    },
-                    default="Unknown recfmt")
-
-# Rec types
-rec_wav_str = Struct(
-    # Substruct under REC
-    "num" / DWORD,
-    "recfmt" / Computed(lambda this: trk_format[this._.trkid].recfmt),
-    "vals" / recfmt_str
-)
-
-rec_num_str = Struct(
-    "recfmt" / Computed(lambda this: trk_format[this._.trkid].recfmt),
-    "num" / Computed(1),
-    "val" / recfmt_str
-)
-
-rec_str_str = Struct(
-    "unused" / DWORD,
-    "sval" / String
-)
-
-# Record structure
-rec_str = Struct(
-    "infolen" / WORD,
-    "dt" / Timestamp(double_, 1, 1970),  # Datetime as unix timestamp
-    "trkid" / WORD,
-    "rec_type" / Computed(lambda this: trk_format[this.trkid].rec_type),
-    "name" / Computed(lambda this: trk_format[this.trkid].name),
-    "values" / Switch(this.rec_type,
-                    {
-                        # WAV type
-                        1: Padded(this._.datalen - this.infolen - 2, rec_wav_str),
-                        # NUM type
-                        2: Padded(this._.datalen - this.infolen - 2, rec_num_str),
-                        # STR type
-                        5: Padded(this._.datalen - this.infolen - 2, rec_str_str),
-                    },
-                    default=Byte[this._.datalen - this.infolen - 2]
-                    )
 
-)
+# CMD names
+cmd_names = {5: 'ORDER', 6: 'RESET_EVENTS'}
 
 # Header
 header_str = Struct(
@@ -117,23 +28,266 @@ header_str = Struct(
     "prog_ver" / DWORD
 )
 
+# Compile the structure once, when the module is loaded. Compiled structures
+# parse several times faster.
+header_str = header_str.compile()
+
 # Body
-body_str = Struct(
-    "type" / OneOf(Byte, [0, 1, 9, 6]),
-    "type_str" /
-    Computed(lambda this: {0: 'TRKINFO', 1: 'REC',
-                        6: 'CMD', 9: 'DEVINFO'}[this.type]),
-    "datalen" / DWORD,
-    "data" / Switch(this.type,
-                    {
-                        # Save Devinfo, For some reason needs padding to match datalen
-                        9: Padded(this.datalen, devinfo_str),
-                        # SAVE_TRKINFO
-                        0: Padded(this.datalen, trkinfo_str) * save_format_hook,
-                        # SAVE_REC
-                        1: Padded(this.datalen, rec_str),
-                        6: Padded(this.datalen, cmd_str), # SAVE_CMD
-                    },
-                    default=Padding(this.datalen))  # Skip data of len datalen if type is unknown
-    
-)
\ No newline at end of file
+# Packets are parsed by hand with struct, as construct is far too slow for
+# the many REC packets in a file.
+PKT_HDR = struct.Struct('<BI')      # type, datalen
+REC_HDR = struct.Struct('<HdH')     # infolen, dt, trkid
+# TRKINFO, around the name and unit strings
+TRKINFO_HEAD = struct.Struct('<HBB')        # trkid, rec_type, recfmt
+TRKINFO_TAIL = struct.Struct('<ff4BfddBI')  # minval, maxval, color, srate, adc_gain, adc_offset, montype, devid
+DWORD_ = struct.Struct('<I')
+WORD_ = struct.Struct('<H')
+BYTE_ = struct.Struct('<B')
+
+packet_types = {0: 'TRKINFO', 1: 'REC', 6: 'CMD', 9: 'DEVINFO'}
+
+# numpy dtype and struct format of each recfmt
+recfmt_dtype = {
+    1: '<f4',
+    2: '<f8',
+    # Actually char, but does not seemn to be used
+    3: 'u1',
+    4: 'u1',
+    5: '<i2',
+    6: '<u2',
+    7: '<i4',
+    8: '<u4'
+}
+recfmt_struct = {recfmt: struct.Struct('<' + fmt) for recfmt, fmt in
+                 {1: 'f', 2: 'd', 3: 'B', 4: 'B', 5: 'h', 6: 'H', 7: 'i', 8: 'I'}.items()}
+
+epoch = arrow.Arrow(1970, 1, 1)
+
+def parse_string(buf, off):
+    '''
+    Parse a string preceded by its length. Returns the string and the offset after it
+    '''
+    strlen, = DWORD_.unpack_from(buf, off)
+    off += 4
+    return bytes(buf[off:off + strlen]).decode('UTF-8'), off + strlen
+
+def parse_trkinfo(buf, start, end):
+    '''
+    Parse TRKINFO packet data in buf[start:end]
+    '''
+    trkid, rec_type, recfmt = TRKINFO_HEAD.unpack_from(buf, start)
+    # Code only tested for float(1) and WORD(6). Others should work as well.
+    if recfmt not in (1, 6):
+        raise ValidationError(f'recfmt {recfmt} of track {trkid} is not supported')
+
+    name, off = parse_string(buf, start + TRKINFO_HEAD.size)
+    unit, off = parse_string(buf, off)
+    if off + TRKINFO_TAIL.size > end:
+        raise StreamError(f'TRKINFO of track {trkid} is longer than its packet')
+
+    tail = TRKINFO_TAIL.unpack_from(buf, off)
+
+    return Container(trkid=trkid, rec_type=rec_type, recfmt=recfmt, name=name, unit=unit,
+                     minval=tail[0], maxval=tail[1], color=list(tail[2:6]), srate=tail[6],
+                     adc_gain=tail[7], adc_offset=tail[8], montype=tail[9], devid=tail[10])
+
+def parse_devinfo(buf, start, end):
+    '''
+    Parse DEVINFO packet data in buf[start:end]
+    '''
+    devid, = DWORD_.unpack_from(buf, start)
+    typename, off = parse_string(buf, start + 4)
+    devname, off = parse_string(buf, off)
+    port, off = parse_string(buf, off)
+    if off > end:
+        raise StreamError(f'DEVINFO of device {devid} is longer than its packet')
+
+    return Container(devid=devid, typename=typename, devname=devname, port=port)
+
+def parse_cmd(buf, start, end):
+    '''
+    Parse CMD packet data in buf[start:end]
+    '''
+    if start + BYTE_.size > end:
+        raise StreamError('CMD is longer than its packet')
+    cmd, = BYTE_.unpack_from(buf, start)
+    cnt = trkids = None
+    if cmd == 5: # ORDER
+        if start + 1 + WORD_.size > end:
+            raise StreamError('CMD ORDER is longer than its packet')
+        cnt, = WORD_.unpack_from(buf, start + 1)
+        if start + 3 + 2 * cnt > end:
+            raise StreamError(f'CMD ORDER of {cnt} tracks is longer than its packet')
+        trkids = list(struct.unpack_from(f'<{cnt}H', buf, start + 3))
+
+    return Container(cmd=cmd, cmd_str=cmd_names.get(cmd, 'Unknown CMD'), cnt=cnt, trkids=trkids)
+
+# Parsers for the values of each rec_type, in buf[start:end]
+def parse_wav_values(buf, start, end, trk):
+    if start + DWORD_.size > end:
+        raise StreamError(f'REC of track {trk.trkid} ended before its number of values')
+    num, = DWORD_.unpack_from(buf, start)
+    dtype = np.dtype(recfmt_dtype[trk.recfmt])
+    if start + 4 + num * dtype.itemsize > end:
+        raise StreamError(f'REC of track {trk.trkid} has {num} values, which is longer than its packet')
+    # View into buf, values are not copied
+    vals = np.frombuffer(buf, dtype=dtype, count=num, offset=start + 4)
+    return Container(num=num, recfmt=trk.recfmt, vals=vals)
+
+def parse_num_values(buf, start, end, trk):
+    fmt = recfmt_struct[trk.recfmt]
+    if start + fmt.size > end:
+        raise StreamError(f'REC of track {trk.trkid} ended before its value')
+    val = fmt.unpack_from(buf, start)
+    return Container(recfmt=trk.recfmt, num=1, val=val)
+
+def parse_str_values(buf, start, end, trk):
+    if start + 2 * DWORD_.size > end:
+        raise StreamError(f'REC of track {trk.trkid} ended before its string')
+    unused, = DWORD_.unpack_from(buf, start)
+    sval, off = parse_string(buf, start + 4)
+    if off > end:
+        raise StreamError(f'String in REC of track {trk.trkid} is longer than its packet')
+    # There is only one value (string) per rec
+    return Container(unused=unused, num=1, sval=sval)
+
+rec_values_parsers = {1: parse_wav_values, 2: parse_num_values, 5: parse_str_values}
+
+def parse_rec(buf, start, end, trk_format):
+    '''
+    Parse REC packet data in buf[start:end]
+    '''
+    infolen, dt, trkid = REC_HDR.unpack_from(buf, start)
+    trk = trk_format[trkid]
+
+    # Values follow the rec info. Unknown rec_types are kept as raw bytes
+    values_start = start + 2 + infolen
+    parse_values = rec_values_parsers.get(trk.rec_type)
+    values = bytes(buf[values_start:end]) if parse_values is None else \
+        parse_values(buf, values_start, end, trk)
+
+    return Container(infolen=infolen, dt=epoch.shift(seconds=dt), trkid=trkid,
+                     rec_type=trk.rec_type, name=trk.name, values=values)
+
+def parse_recs(buf, starts, ends, trk):
+    '''
+    Parse the REC packets of one track, with data in buf[start:end] for each start and end.
+    The track format and values parser are looked up once, not per rec.
+    '''
+    rec_type = trk.rec_type
+    name = trk.name
+    parse_values = rec_values_parsers.get(rec_type)
+    recs = []
+    for start, end in zip(starts, ends):
+        infolen, dt, trkid = REC_HDR.unpack_from(buf, start)
+        values_start = start + 2 + infolen
+        values = bytes(buf[values_start:end]) if parse_values is None else \
+            parse_values(buf, values_start, end, trk)
+        recs.append(Container(infolen=infolen, dt=epoch.shift(seconds=dt), trkid=trkid,
+                              rec_type=rec_type, name=name, values=values))
+    return recs
+
+def parse_packet(buf, off, trk_format):
+    '''
+    Parse the packet starting at buf[off].
+    Returns the packet type, datalen, data and the offset of the next packet.
+    TRKINFO packets are added to trk_format, which REC packets are parsed against (see parse_rec).
+    Vital.load_vital only parses non-REC packets here. RECs are parsed per track with parse_recs.
+    '''
+    if off + PKT_HDR.size > len(buf):
+        raise StreamError('stream ended before packet header')
+
+    pkt_type, datalen = PKT_HDR.unpack_from(buf, off)
+    start = off + PKT_HDR.size
+    end = start + datalen
+
+    if end > len(buf):
+        raise StreamError('stream ended before end of packet')
+
+    if pkt_type == 1: # SAVE_REC
+        data = parse_rec(buf, start, end, trk_format)
+    elif pkt_type == 0: # SAVE_TRKINFO
+        data = parse_trkinfo(buf, start, end)
+        trk_format[data.trkid] = data
+    elif pkt_type == 9: # Save Devinfo
+        data = parse_devinfo(buf, start, end)
+    elif pkt_type == 6: # SAVE_CMD
+        data = parse_cmd(buf, start, end)
+    else: # Skip data if type is unknown
+        data = None
+
+    return pkt_type, datalen, data, end
+
+def scan_packets(buf, off):
+    '''
+    Walk the chain of packets in buf, starting at off.
+    Returns arrays with the type, offset of the data and datalen of every packet,
+    and the offset where the walk stopped. That is len(buf), unless the last packet is truncated.
+    '''
+    if njit is not None:
+        return scan_packets_jit(np.frombuffer(buf, dtype=np.uint8), off)
+
+    types, offsets, datalens = [], [], []
+    while off + PKT_HDR.size <= len(buf):
+        pkt_type, datalen = PKT_HDR.unpack_from(buf, off)
+        if off + PKT_HDR.size + datalen > len(buf):
+            break
+        types.append(pkt_type)
+        offsets.append(off + PKT_HDR.size)
+        datalens.append(datalen)
+        off += PKT_HDR.size + datalen
+
+    return (np.array(types, dtype=np.uint8), np.array(offsets, dtype=np.int64),
+            np.array(datalens, dtype=np.int64), off)
+
+def _scan_packets_bytes(data, off):
+    # scan_packets on a uint8 array, for numba.
+    # Counts the packets first, so the output arrays can be allocated once.
+    n = 0
+    pos = off
+    while pos + 5 <= data.shape[0]:
+        datalen = np.int64(data[pos + 1]) | np.int64(data[pos + 2]) << 8 | \
+            np.int64(data[pos + 3]) << 16 | np.int64(data[pos + 4]) << 24
+        if pos + 5 + datalen > data.shape[0]:
+            break
+        n += 1
+        pos += 5 + datalen
+
+    types = np.empty(n, dtype=np.uint8)
+    offsets = np.empty(n, dtype=np.int64)
+    datalens = np.empty(n, dtype=np.int64)
+    pos = off
+    for i in range(n):
+        datalen = np.int64(data[pos + 1]) | np.int64(data[pos + 2]) << 8 | \
+            np.int64(data[pos + 3]) << 16 | np.int64(data[pos + 4]) << 24
+        types[i] = data[pos]
+        offsets[i] = pos + 5
+        datalens[i] = datalen
+        pos += 5 + datalen
+
+    return types, offsets, datalens, pos
+
+if njit is not None:
+    scan_packets_jit = njit(cache=True)(_scan_packets_bytes)
+
+def _adc_apply(raw, gain, offset, out):
+    # out = raw * gain + offset, for numba.
+    # Not fastmath, so results are the same as with numpy.
+    for i in prange(raw.shape[0]):
+        out[i] = raw[i] * gain + offset
+
+if njit is not None:
+    adc_apply = njit(parallel=True, cache=True)(_adc_apply)
+else:
+    adc_apply = None
+
+def rec_headers(buf, offsets):
+    '''
+    trkid and dt of the REC packets with data at offsets, as arrays
+    '''
+    data = np.frombuffer(buf, dtype=np.uint8)
+    # REC data starts with infolen (WORD), dt (double) and trkid (WORD)
+    fields = data[offsets[:, None] + np.arange(REC_HDR.size)]
+    dts = fields[:, 2:10].copy().view('<f8').ravel()
+    trkids = fields[:, 10:12].copy().view('<u2').ravel()
+    return trkids, dts